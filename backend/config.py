@@ -1,6 +1,7 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 from pydantic import ConfigDict
-from typing import Optional
+from typing import List, Optional
 
 
 class Settings(BaseSettings):
@@ -8,6 +9,11 @@ class Settings(BaseSettings):
     openai_api_key: str
     openai_base_url: str
     model_name: str
+    fallback_model_names: List[str] = []
+    llm_timeout: float = 60.0
+    llm_max_retries: int = 2
+    llm_cache_ttl: int = 3600  # Seconds to reuse identical-prompt completions; 0 disables
+    stream_hold_reasoning: bool = True  # Hold streamed text until </think>; false for non-reasoning models
     
     # Weaviate Configuration
     weaviate_url: str
@@ -18,15 +24,25 @@ class Settings(BaseSettings):
     gemini_api_key: str
     embedding_model: str
     expected_embedding_dim: int
+    rag_cache_ttl: int = 300  # 0 disables
+    embedding_cache_ttl: int = 604800  # 0 disables
+    
+    # Reranker Configuration (cross-encoder, e.g. BAAI/bge-reranker-v2-m3; unset disables)
+    rerank_model: Optional[str] = None
+    rerank_candidates: int = 30
+    rerank_cache_ttl: int = 900  # 0 disables
     
     # Redis Configuration
     redis_host: str = "localhost"
     redis_port: int = 6379
     redis_db: int = 0
     redis_password: Optional[str] = None
+    redis_max_connections: int = 64
     
     # Token Configuration
     max_tokens: int = 30000
+    max_completion_tokens: int = 2000
+    model_context_window: int = 32768
     model_hf_path: str
     
     # Application Configuration
@@ -35,8 +51,15 @@ class Settings(BaseSettings):
     model_config = ConfigDict(
         env_file=".env",
         case_sensitive=False,
-        extra="ignore"
+        extra="ignore",
+        frozen=True
     )
 
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Load and validate settings once per process."""
+    return Settings()
+
+
+settings = get_settings()
@@ -1,9 +1,12 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import BinaryIO, Optional
+from contextlib import asynccontextmanager
+import asyncio
 import os
+import shutil
 import uuid
 from pathlib import Path
 
@@ -11,8 +14,29 @@ from config import settings
 from services.chat import chat_service
 from services.pdf_handler import pdf_handler
 from services.storage import storage
+from services import rag
+from services.tokenizer import get_tokenizer
 
-app = FastAPI(title="Chatbot API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the shared Weaviate connection once per worker
+    try:
+        await asyncio.to_thread(rag.get_client)
+    except Exception as e:
+        print(f"Weaviate warm-up failed, will retry on first query: {e}")
+    # Load the tokenizer before the first chat needs it
+    await asyncio.to_thread(get_tokenizer)
+    yield
+    rag.close_client()
+
+
+app = FastAPI(
+    title="Chatbot API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # CORS middleware
 app.add_middleware(
@@ -26,6 +50,8 @@ app.add_middleware(
 # Ensure upload directory exists
 Path(settings.upload_dir).mkdir(parents=True, exist_ok=True)
 
+UPLOAD_CHUNK_SIZE = 1 << 20
+
 
 class ChatRequest(BaseModel):
     session_id: str
@@ -49,13 +75,36 @@ async def root():
     return {"message": "Chatbot API is running"}
 
 
+def _ingest_pdf(session_id: str, filename: str, file_path: str, source: BinaryIO) -> None:
+    """
+    Save an uploaded PDF, extract its text and store it as a pending document.
+    Blocking (disk writes, PyMuPDF/OCR + Redis), so callers run it off the event loop.
+    """
+    # Copy in 1 MiB chunks so large PDFs are never held in memory whole
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(source, f, UPLOAD_CHUNK_SIZE)
+    
+    extracted_text = pdf_handler.extract_text(file_path)
+    
+    # Store the pending document (don't add to chat history yet)
+    storage.add_pending_document(
+        session_id=session_id,
+        filename=filename,
+        file_path=file_path,
+        extracted_text=extracted_text
+    )
+
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """
     Handle chat messages with history management and RAG.
     """
     try:
-        response = chat_service.chat(
+        # Run the blocking Redis/Weaviate/LLM round-trips in a worker thread
+        # so other sessions are served while this one waits on the model
+        response = await asyncio.to_thread(
+            chat_service.chat,
             session_id=request.session_id,
             user_message=request.message,
             include_rag=request.include_rag
@@ -65,6 +114,21 @@ async def chat(request: ChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Handle chat messages, streaming the reply as Server-Sent Events.
+    """
+    return StreamingResponse(
+        chat_service.chat_stream(
+            session_id=request.session_id,
+            user_message=request.message,
+            include_rag=request.include_rag
+        ),
+        media_type="text/event-stream"
+    )
+
+
 @app.post("/upload", response_model=UploadResponse)
 async def upload_pdf(
     file: UploadFile = File(...),
@@ -83,20 +147,8 @@ async def upload_pdf(
         file_id = str(uuid.uuid4())
         file_path = os.path.join(settings.upload_dir, f"{file_id}_{file.filename}")
         
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-        
-        # Extract text
-        extracted_text = pdf_handler.extract_text(file_path)
-        
-        # Store the pending document (don't add to chat history yet)
-        storage.add_pending_document(
-            session_id=session_id,
-            filename=file.filename,
-            file_path=file_path,
-            extracted_text=extracted_text
-        )
+        # Save and extract in a worker thread so concurrent requests aren't blocked
+        await asyncio.to_thread(_ingest_pdf, session_id, file.filename, file_path, file.file)
         
         return UploadResponse(
             message="PDF uploaded successfully",
@@ -108,7 +160,7 @@ async def upload_pdf(
 
 
 @app.delete("/history/{session_id}")
-async def clear_history(session_id: str):
+def clear_history(session_id: str):
     """
     Clear chat history for a session.
     """
@@ -117,7 +169,7 @@ async def clear_history(session_id: str):
 
 
 @app.get("/history/{session_id}")
-async def get_history(session_id: str):
+def get_history(session_id: str):
     """
     Retrieve chat history for a session.
     """
@@ -126,7 +178,7 @@ async def get_history(session_id: str):
 
 
 @app.get("/sessions")
-async def get_all_sessions():
+def get_all_sessions():
     """
     Get all chat sessions with metadata.
     """
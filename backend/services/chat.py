@@ -1,30 +1,74 @@
-from typing import List, Dict, Optional
-from openai import OpenAI
-import weaviate
+from typing import List, Dict, Iterator, Optional, Tuple
+import hashlib
+import re
+import orjson
+from openai import (
+    OpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
 from config import settings
+from services.cache import SingleFlight
 from services.storage import storage
-from services.tokenizer import count_messages_tokens
-from services.rag import get_context
+from services.tokenizer import count_messages_tokens, message_token_counts
+from services.rag import get_context, CONTEXT_SEPARATOR
+
+
+# Matches a context block header: Source: filename (Chunk chunk_idx, ...
+_SOURCE_RE = re.compile(r'Source:\s+([^\(]+)\s+\(Chunk\s+(\d+)')
+
+# Errors worth trying a fallback model for once the SDK's own retries are spent
+_TRANSIENT_LLM_ERRORS = (APITimeoutError, RateLimitError, APIConnectionError, InternalServerError)
+
+# Whole-message small talk that never needs knowledge-base retrieval
+_SMALL_TALK_RE = re.compile(
+    r'^\s*(hi|hello|hey|thanks|thank you|thx|ok|okay|bye|goodbye|repeat that|say that again)[\s!.,?]*$',
+    re.IGNORECASE
+)
+
+# Start of a context block: [Context N] Source: ...
+_BLOCK_HEADER_RE = re.compile(r'\[Context \d+\] Source:')
+
+# Static instructions; kept byte-identical across turns so the prompt prefix stays cacheable
+SYSTEM_PROMPT = """
+        You are a strict Tax Compliance Analyst assistant. Your goal is to verify user documents against a provided set of reference rules.
+
+        # STRICT KNOWLEDGE CONSTRAINTS
+        1.  **CONTEXT IS GOD:** You must answer the user's query **exclusively** using the information provided within the <knowledge_base> tags.
+        2.  **NO OUTSIDE KNOWLEDGE:** Do not use your internal training data, general knowledge of Bangladeshi law, or common sense to fill in gaps. If a specific section, act, or rule is not explicitly written in the <knowledge_base>, it does not exist.
+        3.  **MANDATORY REFUSAL:** If the answer is not contained verbatim or logically derived *only* from the <knowledge_base>, you must reply: "I don't have enough information to answer this question based on the provided context."
+        
+        # OPERATIONAL DIRECTIVES
+        1.  **Analyze Documents:** Review the content within <user_document>.
+        2.  **Compare:** Cross-reference the user's document *only* against the specific rules found in <knowledge_base>.
+        3.  **Citation:** When finding a match or violation, cite the specific reference (e.g., "Section 45, Act 17") exactly as it appears in the knowledge base.
+        4.  **Tone:** Maintain a professional, objective tone.
+
+        # INPUT DATA
+        """
 
 
 class ChatService:
     def __init__(self):
         # Initialize OpenAI client (compatible with vLLM)
+        # The SDK's default httpx client already pools keep-alive connections.
+        # The SDK retries timeouts, 429s and 5xx with jittered exponential backoff.
         self.llm_client = OpenAI(
             api_key=settings.openai_api_key,
-            base_url=settings.openai_base_url
+            base_url=settings.openai_base_url,
+            timeout=settings.llm_timeout,
+            max_retries=settings.llm_max_retries
         )
-        
-        # # Initialize Weaviate client
-        # self.weaviate_client = weaviate.Client(
-        #     url=settings.weaviate_url,
-        #     auth_client_secret=weaviate.AuthApiKey(api_key=settings.weaviate_api_key)
-        # )
+        self._llm_inflight = SingleFlight()
     
     def truncate_history(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
         """
         Truncate message history if token count exceeds limit.
         Always protects the first message (system prompt).
+        Each message is tokenized once; the oldest messages are then dropped
+        from a running total instead of re-counting the whole history.
         
         Args:
             messages: List of message dictionaries
@@ -32,16 +76,23 @@ class ChatService:
         Returns:
             List[Dict[str, str]]: Truncated messages
         """
-        while len(messages) > 2:  # Keep at least system prompt + one other message
-            token_count = count_messages_tokens(messages)
-            if token_count <= settings.max_tokens:
-                break
-            # Remove second message (first after system prompt)
-            messages.pop(1)
-        
-        return messages
+        if len(messages) <= 2:  # Keep at least system prompt + one other message
+            return messages
+        
+        per_message = message_token_counts(messages)
+        total = sum(per_message)
+        
+        # Drop messages after the system prompt until within the limit
+        cut = 1
+        while cut < len(messages) - 1 and total > settings.max_tokens:
+            total -= per_message[cut]
+            cut += 1
+        
+        if cut == 1:
+            return messages
+        return [messages[0]] + messages[cut:]
     
-    def get_rag_context(self, query: str, limit: int = 3) -> str:
+    def get_rag_context(self, query: str, limit: int = 4) -> str:
         """
         Retrieve relevant context from Weaviate RAG.
         
@@ -50,30 +101,26 @@ class ChatService:
             limit: Number of results to retrieve
             
         Returns:
-            str: Concatenated context
+            str: Formatted context blocks, or "" on failure
         """
         try:
-            # Query Weaviate (adjust class name and properties as needed)
-            result = (
-                self.weaviate_client.query
-                .get("Document", ["content", "metadata"])
-                .with_near_text({"concepts": [query]})
-                .with_limit(limit)
-                .do()
-            )
-            
-            # Extract and concatenate context
-            contexts = []
-            if "data" in result and "Get" in result["data"]:
-                documents = result["data"]["Get"].get("Document", [])
-                for doc in documents:
-                    contexts.append(doc.get("content", ""))
-            
-            return "\n\n".join(contexts)
+            return get_context(query, top_k=limit)
         except Exception as e:
             print(f"RAG retrieval error: {e}")
             return ""
     
+    def _needs_rag(self, user_message: str) -> bool:
+        """
+        Decide whether a message warrants knowledge-base retrieval.
+        
+        Args:
+            user_message: User's message
+            
+        Returns:
+            bool: False for greetings/acknowledgements, True otherwise
+        """
+        return not _SMALL_TALK_RE.match(user_message)
+    
     def _initialize_system_prompt(self) -> Dict[str, str]:
         """
         Create the initial system prompt with empty knowledge base.
@@ -81,130 +128,96 @@ class ChatService:
         Returns:
             Dict[str, str]: System message dictionary
         """
-        sys_ins = f"""
-        You are a strict Tax Compliance Analyst assistant. Your goal is to verify user documents against a provided set of reference rules.
-
-        # STRICT KNOWLEDGE CONSTRAINTS
-        1.  **CONTEXT IS GOD:** You must answer the user's query **exclusively** using the information provided within the <knowledge_base> tags.
-        2.  **NO OUTSIDE KNOWLEDGE:** Do not use your internal training data, general knowledge of Bangladeshi law, or common sense to fill in gaps. If a specific section, act, or rule is not explicitly written in the <knowledge_base>, it does not exist.
-        3.  **MANDATORY REFUSAL:** If the answer is not contained verbatim or logically derived *only* from the <knowledge_base>, you must reply: "I don't have enough information to answer this question based on the provided context."
+        return self._render_system_prompt({})
+    
+    def _render_system_prompt(self, knowledge_base: Dict[Tuple[str, int], str]) -> Dict[str, str]:
+        """
+        Render the system prompt with the session's knowledge base.
         
-        # OPERATIONAL DIRECTIVES
-        1.  **Analyze Documents:** Review the content within <user_document>.
-        2.  **Compare:** Cross-reference the user's document *only* against the specific rules found in <knowledge_base>.
-        3.  **Citation:** When finding a match or violation, cite the specific reference (e.g., "Section 45, Act 17") exactly as it appears in the knowledge base.
-        4.  **Tone:** Maintain a professional, objective tone.
-
-        # INPUT DATA
+        Args:
+            knowledge_base: Context blocks keyed by (filename, chunk_idx)
+            
+        Returns:
+            Dict[str, str]: System message dictionary
         """
-
+        kb_text = f"\n\n{CONTEXT_SEPARATOR}\n\n".join(knowledge_base.values())
+        if kb_text:
+            kb_text += "\n"
+        
         return {
             "role": "system",
-            "content": sys_ins + "\n\n<knowledge_base>\n</knowledge_base>"
+            "content": SYSTEM_PROMPT + f"\n\n<knowledge_base>\n{kb_text}</knowledge_base>"
         }
     
-    def _extract_context_identifiers(self, context_text: str) -> set:
+    def _parse_context_blocks(self, context_text: str) -> Dict[Tuple[str, int], str]:
         """
-        Extract unique identifiers from context blocks.
+        Split context text into blocks keyed by source.
         Each context block has format: [Context N] Source: filename (Chunk chunk_idx, ...)
         
         Args:
             context_text: Context text containing multiple context blocks
             
         Returns:
-            set: Set of tuples (filename, chunk_idx) representing unique contexts
+            Dict[Tuple[str, int], str]: Block text keyed by (filename, chunk_idx),
+            first occurrence wins
         """
-        import re
-        identifiers = set()
+        blocks = {}
+        starts = [m.start() for m in _BLOCK_HEADER_RE.finditer(context_text)]
         
-        # Pattern to match: Source: filename (Chunk chunk_idx, ...
-        pattern = r'Source:\s+([^\(]+)\s+\(Chunk\s+(\d+)'
-        matches = re.findall(pattern, context_text)
-        
-        for filename, chunk_idx in matches:
-            identifiers.add((filename.strip(), int(chunk_idx)))
+        for start, end in zip(starts, starts[1:] + [len(context_text)]):
+            block = context_text[start:end].split(CONTEXT_SEPARATOR)[0].strip()
+            match = _SOURCE_RE.search(block)
+            if match:
+                blocks.setdefault((match.group(1).strip(), int(match.group(2))), block)
         
-        return identifiers
+        return blocks
     
-    def _update_knowledge_base(self, system_content: str, new_context: str) -> str:
+    def _parse_legacy_knowledge_base(self, system_content: str) -> Dict[Tuple[str, int], str]:
         """
-        Append new RAG context to the knowledge base in system prompt.
-        Deduplicates contexts based on filename and chunk_index.
+        Extract the knowledge base carried inline in an older session's system prompt.
+        Only the text between the <knowledge_base> tags is parsed, located the
+        same way the old inline update did, so the closing tag never ends up
+        in the last block.
         
         Args:
-            system_content: Current system message content
-            new_context: New context to append
+            system_content: Stored system message content
             
         Returns:
-            str: Updated system content with appended context
+            Dict[Tuple[str, int], str]: Block text keyed by (filename, chunk_idx)
         """
-        # Find the knowledge_base tags
         kb_start = system_content.find("<knowledge_base>")
         kb_end = system_content.find("</knowledge_base>")
-        
         if kb_start == -1 or kb_end == -1:
-            # If tags don't exist, add them with the new context
-            return system_content + f"\n\n<knowledge_base>\n{new_context}\n</knowledge_base>"
-        
-        # Extract current knowledge base content
-        kb_content = system_content[kb_start + len("<knowledge_base>"):kb_end].strip()
-        
-        # Get existing context identifiers
-        existing_identifiers = self._extract_context_identifiers(kb_content)
-        
-        # Parse new context blocks and filter out duplicates
-        import re
-        new_context_blocks = []
-        
-        # Split new context into individual blocks
-        # Context blocks are separated by "=" * 80
-        context_parts = new_context.split("=" * 80)
+            return {}
+        return self._parse_context_blocks(system_content[kb_start + len("<knowledge_base>"):kb_end])
+    
+    def _merge_knowledge_base(self, knowledge_base: Dict[Tuple[str, int], str], new_context: str) -> int:
+        """
+        Add new RAG context blocks to the knowledge base.
+        Deduplicates contexts based on filename and chunk_index.
         
-        for part in context_parts:
-            part = part.strip()
-            if not part:
-                continue
-            
-            # Extract identifier from this context block
-            pattern = r'Source:\s+([^\(]+)\s+\(Chunk\s+(\d+)'
-            match = re.search(pattern, part)
+        Args:
+            knowledge_base: Existing blocks, updated in place
+            new_context: New context to merge
             
-            if match:
-                filename = match.group(1).strip()
-                chunk_idx = int(match.group(2))
-                identifier = (filename, chunk_idx)
-                
-                # Only add if not already in knowledge base
-                if identifier not in existing_identifiers:
-                    new_context_blocks.append(part)
-                    existing_identifiers.add(identifier)
-        
-        # If no new contexts to add, return unchanged
-        if not new_context_blocks:
-            return system_content
-        
-        # Append new unique contexts
-        new_contexts_text = "\n\n" + ("=" * 80 + "\n\n").join(new_context_blocks)
-        
-        if kb_content:
-            updated_kb = kb_content + new_contexts_text
-        else:
-            updated_kb = new_contexts_text.strip()
-        
-        # Reconstruct the system content
-        before_kb = system_content[:kb_start]
-        after_kb = system_content[kb_end + len("</knowledge_base>"):]
-        
-        return f"{before_kb}<knowledge_base>\n{updated_kb}\n</knowledge_base>{after_kb}"
+        Returns:
+            int: Number of blocks added
+        """
+        added = 0
+        for identifier, block in self._parse_context_blocks(new_context).items():
+            if identifier not in knowledge_base:
+                knowledge_base[identifier] = block
+                added += 1
+        return added
     
-    def chat(
+    def _prepare_turn(
         self,
         session_id: str,
         user_message: str,
-        include_rag: bool = True
-    ) -> str:
+        include_rag: bool
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
         """
-        Process a chat message with history management and RAG.
+        Load history, attach pending documents and RAG context for a new turn.
         
         Args:
             session_id: Unique session identifier
@@ -212,10 +225,11 @@ class ChatService:
             include_rag: Whether to include RAG context
             
         Returns:
-            str: Assistant's response
+            Tuple: (new messages not yet persisted, truncated messages to send)
         """
         # Get history from Redis
         history = storage.get_history(session_id)
+        persisted = len(history)
         
         # Initialize with system prompt if this is a new session
         if not history:
@@ -240,47 +254,272 @@ class ChatService:
         # Add user message to history
         history.append({"role": "user", "content": complete_message})
         
-        # Prepare messages for LLM
-        messages = history.copy()
+        # Knowledge base is stored separately and rendered into the prompt
+        knowledge_base = storage.get_knowledge_base(session_id)
+        kb_changed = False
+        
+        # Older sessions carry the knowledge base inline in the system prompt
+        initial_prompt = self._initialize_system_prompt()
+        if history[0]["content"] != initial_prompt["content"]:
+            for identifier, block in self._parse_legacy_knowledge_base(history[0]["content"]).items():
+                knowledge_base.setdefault(identifier, block)
+            history[0] = initial_prompt
+            storage.save_history(session_id, history[:persisted])
+            kb_changed = True
         
         # Add RAG context if enabled
-        if include_rag:
-            rag_context = get_context(user_message)
-            if rag_context:
-                # Update the system prompt's knowledge base
-                messages[0]["content"] = self._update_knowledge_base(
-                    messages[0]["content"],
-                    rag_context
-                )
-
+        if include_rag and self._needs_rag(user_message):
+            rag_context = self.get_rag_context(user_message)
+            if rag_context and self._merge_knowledge_base(knowledge_base, rag_context):
+                kb_changed = True
+        
+        if kb_changed:
+            storage.save_knowledge_base(session_id, knowledge_base)
+        
         # Truncate if exceeds token limit (protects system prompt)
-        messages = self.truncate_history(messages)
+        messages = self.truncate_history(
+            [self._render_system_prompt(knowledge_base)] + history[1:]
+        )
         
-        # Call LLM
-        try:
-            response = self.llm_client.chat.completions.create(
-                model=settings.model_name,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=2000
-            )
-            
-            assistant_message = response.choices[0].message.content.split("</think>")[-1]
+        return history[persisted:], messages
+    
+    def _create_completion(self, messages: List[Dict[str, str]], stream: bool = False):
+        """
+        Call the LLM with the configured model and sampling parameters,
+        falling back to the next configured model on transient failures.
+        
+        Args:
+            messages: Messages to send
+            stream: Whether to request a streamed response
             
-            # Add assistant response to history
-            history.append({"role": "assistant", "content": assistant_message})
+        Returns:
+            The completion, or a chunk iterator when streaming
+        """
+        # Reserve only what fits in the context window next to the prompt
+        prompt_tokens = count_messages_tokens(messages)
+        max_tokens = max(
+            256,
+            min(settings.max_completion_tokens, settings.model_context_window - prompt_tokens - 64)
+        )
+        
+        models = [settings.model_name, *settings.fallback_model_names]
+        for i, model in enumerate(models):
+            try:
+                return self.llm_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=max_tokens,
+                    stream=stream
+                )
+            except _TRANSIENT_LLM_ERRORS as e:
+                # Retries on this model are exhausted; move to the next one
+                if i == len(models) - 1:
+                    raise
+                print(f"LLM model {model} unavailable ({e}), falling back to {models[i + 1]}")
+    
+    def _response_cache_key(self, messages: List[Dict[str, str]]) -> str:
+        """
+        Build the response-cache key for an exact prompt.
+        The whole message list (system prompt with knowledge base, history
+        and documents) is hashed, so a hit only occurs for identical input.
+        
+        Args:
+            messages: Messages that would be sent to the LLM
             
-            # Save updated history
-            storage.save_history(session_id, history)
+        Returns:
+            str: Redis key for the cached completion
+        """
+        payload = orjson.dumps([settings.model_name, messages])
+        return "llm:" + hashlib.blake2b(payload, digest_size=16).hexdigest()
+    
+    def _get_cached_response(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Return a cached raw completion for these messages, if any."""
+        if settings.llm_cache_ttl <= 0:
+            return None
+        cached = storage.get_cached(self._response_cache_key(messages))
+        return cached.decode() if cached is not None else None
+    
+    def _cache_response(self, messages: List[Dict[str, str]], content: str) -> None:
+        """Cache a raw completion for these messages."""
+        if settings.llm_cache_ttl > 0 and content:
+            storage.set_cached(self._response_cache_key(messages), content, settings.llm_cache_ttl)
+    
+    def _complete_and_cache(self, messages: List[Dict[str, str]]) -> str:
+        """Run a non-streamed completion and cache its raw content."""
+        response = self._create_completion(messages)
+        content = response.choices[0].message.content
+        self._cache_response(messages, content)
+        return content
+    
+    def _complete_turn(self, session_id: str, new_messages: List[Dict[str, str]], content: str) -> str:
+        """
+        Strip reasoning, persist the assistant reply and touch the session.
+        
+        Args:
+            session_id: Unique session identifier
+            new_messages: Unsaved messages of this turn, ending with the user message
+            content: Raw LLM output
             
-            # Update session timestamp
-            storage.update_session_timestamp(session_id)
+        Returns:
+            str: Assistant's response
+        """
+        assistant_message = content.split("</think>")[-1]
+        
+        # Add assistant response to history
+        new_messages.append({"role": "assistant", "content": assistant_message})
+        
+        # Append the turn to the stored history; a new session's first turn
+        # carries the system prompt, which must only be written once
+        if new_messages[0]["role"] == "system":
+            storage.start_history(session_id, new_messages)
+        else:
+            storage.append_messages(session_id, new_messages)
+        
+        # Update session timestamp
+        storage.update_session_timestamp(session_id)
+        
+        return assistant_message
+    
+    def chat(
+        self,
+        session_id: str,
+        user_message: str,
+        include_rag: bool = True
+    ) -> str:
+        """
+        Process a chat message with history management and RAG.
+        
+        Args:
+            session_id: Unique session identifier
+            user_message: User's message
+            include_rag: Whether to include RAG context
             
-            return assistant_message
+        Returns:
+            str: Assistant's response
+        """
+        new_messages, messages = self._prepare_turn(session_id, user_message, include_rag)
+        
+        # Identical prompts reuse the earlier completion
+        cached = self._get_cached_response(messages)
+        if cached is not None:
+            return self._complete_turn(session_id, new_messages, cached)
+        
+        # Call LLM; identical prompts already in flight share one completion
+        try:
+            content = self._llm_inflight.do(
+                self._response_cache_key(messages),
+                self._complete_and_cache,
+                messages
+            )
+            return self._complete_turn(session_id, new_messages, content)
         except Exception as e:
             error_msg = f"Error calling LLM: {str(e)}"
             print(error_msg)
             return error_msg
+    
+    def chat_stream(
+        self,
+        session_id: str,
+        user_message: str,
+        include_rag: bool = True
+    ) -> Iterator[str]:
+        """
+        Process a chat message and stream the reply as Server-Sent Events.
+        Yields {"delta": ...} events as answer tokens arrive (reasoning up to
+        </think> is withheld), then a final
+        {"done": true, "response": ...} event with the cleaned reply.
+        History is saved once, after the stream completes.
+        
+        Args:
+            session_id: Unique session identifier
+            user_message: User's message
+            include_rag: Whether to include RAG context
+            
+        Yields:
+            str: SSE-formatted event
+        """
+        parts = []
+        
+        def raw_deltas(messages: List[Dict[str, str]]) -> Iterator[str]:
+            for chunk in self._create_completion(messages, stream=True):
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        
+        # Headers are already sent once streaming starts, so every failure,
+        # including storage and tokenizer errors, must end in an error event
+        try:
+            new_messages, messages = self._prepare_turn(session_id, user_message, include_rag)
+            
+            # Identical prompts reuse the earlier completion
+            cached = self._get_cached_response(messages)
+            if cached is not None:
+                assistant_message = self._complete_turn(session_id, new_messages, cached)
+                yield _sse_event({"delta": assistant_message})
+                yield _sse_event({"done": True, "response": assistant_message})
+                return
+            
+            for delta in _strip_reasoning(raw_deltas(messages), hold=settings.stream_hold_reasoning):
+                yield _sse_event({"delta": delta})
+            
+            content = "".join(parts)
+            self._cache_response(messages, content)
+            assistant_message = self._complete_turn(session_id, new_messages, content)
+            yield _sse_event({"done": True, "response": assistant_message})
+        except Exception as e:
+            error_msg = f"Error processing chat: {str(e)}"
+            print(error_msg)
+            yield _sse_event({"error": error_msg})
+
+
+_THINK_CLOSE = "</think>"
+
+
+def _strip_reasoning(deltas: Iterator[str], hold: bool = True) -> Iterator[str]:
+    """
+    Forward streamed text without the model's reasoning, matching what
+    _complete_turn keeps (everything after the last </think>).
+    Reasoning models often get the opening <think> from the chat template,
+    so output is held back until </think> appears; if the stream ends
+    without one, the whole reply is sent. A </think> tag is never forwarded.
+    
+    Args:
+        deltas: Raw text deltas from the LLM
+        hold: Hold output until </think>; False streams immediately
+        
+    Yields:
+        str: Text to send to the client
+    """
+    pending = ""
+    for delta in deltas:
+        pending += delta
+        if _THINK_CLOSE in pending:
+            head, _, pending = pending.rpartition(_THINK_CLOSE)
+            if not hold and head:
+                yield head.replace(_THINK_CLOSE, "")
+            hold = False
+        if hold:
+            continue
+        # Keep back a tail that could be the start of a split </think>
+        keep = next(
+            (k for k in range(min(len(_THINK_CLOSE) - 1, len(pending)), 0, -1)
+             if pending.endswith(_THINK_CLOSE[:k])),
+            0
+        )
+        if len(pending) > keep:
+            yield pending[:len(pending) - keep]
+            pending = pending[len(pending) - keep:]
+    if pending:
+        yield pending
+
+
+def _sse_event(payload: Dict) -> str:
+    """Format a payload as a single Server-Sent Events message."""
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
 
 
 # Singleton instance
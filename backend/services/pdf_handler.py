@@ -1,11 +1,54 @@
 import fitz  # PyMuPDF
 import pytesseract
-from pdf2image import convert_from_path
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 import tempfile
 import os
 
+# LSTM engine only; skips the slower legacy+LSTM combined mode
+OCR_CONFIG = "--oem 1"
+
+# Render resolution for OCR; grayscale halves bytes per page versus RGB
+OCR_DPI = 200
+
+def _otsu_threshold(histogram: List[int]) -> int:
+    """
+    Compute Otsu's threshold for a 256-bin grayscale histogram.
+    
+    Args:
+        histogram: Pixel counts per gray level
+        
+    Returns:
+        int: Gray level that best separates foreground from background
+    """
+    total = sum(histogram)
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+    
+    background, weighted_background = 0, 0
+    best_level, best_variance = 0, 0.0
+    for level, count in enumerate(histogram):
+        background += count
+        if background == 0:
+            continue
+        foreground = total - background
+        if foreground == 0:
+            break
+        weighted_background += level * count
+        mean_background = weighted_background / background
+        mean_foreground = (weighted_total - weighted_background) / foreground
+        variance = background * foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_level, best_variance = level, variance
+    return best_level
+
+
+def _binarize(image: Image.Image) -> Image.Image:
+    """Binarize a grayscale page with Otsu's threshold (a 256-entry lookup table)."""
+    threshold = _otsu_threshold(image.histogram())
+    return image.point([0] * (threshold + 1) + [255] * (255 - threshold))
+
 
 class PDFHandler:
     def __init__(self, min_text_threshold: int = 50):
@@ -16,6 +59,32 @@ class PDFHandler:
             min_text_threshold: Minimum characters to consider text extraction successful
         """
         self.min_text_threshold = min_text_threshold
+        # Each pytesseract call runs in its own tesseract process, so threads
+        # are enough to keep every core busy without pickling page images
+        self.ocr_workers = os.cpu_count() or 1
+        self._ocr_pool = ThreadPoolExecutor(max_workers=self.ocr_workers)
+    
+    def _extract_native_text(self, doc: fitz.Document) -> str:
+        """Extract the embedded text layer from an open document."""
+        return "".join(page.get_text() for page in doc).strip()
+    
+    def _extract_ocr_text(self, doc: fitz.Document) -> str:
+        """
+        OCR an open document. Pages are rendered in memory with PyMuPDF
+        and handed to the OCR pool as soon as each one is ready.
+        """
+        futures = []
+        for page in doc:
+            pix = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY, alpha=False)
+            # Pre-binarized input lets Tesseract skip its own thresholding pass
+            image = _binarize(Image.frombytes("L", (pix.width, pix.height), pix.samples))
+            futures.append(
+                self._ocr_pool.submit(pytesseract.image_to_string, image, config=OCR_CONFIG)
+            )
+        
+        return "".join(
+            f"\n--- Page {i+1} ---\n{future.result()}" for i, future in enumerate(futures)
+        ).strip()
     
     def extract_text_pymupdf(self, pdf_path: str) -> str:
         """
@@ -27,15 +96,12 @@ class PDFHandler:
         Returns:
             str: Extracted text
         """
-        text = ""
         try:
-            doc = fitz.open(pdf_path)
-            for page in doc:
-                text += page.get_text()
-            doc.close()
+            with fitz.open(pdf_path) as doc:
+                return self._extract_native_text(doc)
         except Exception as e:
             print(f"PyMuPDF extraction error: {e}")
-        return text.strip()
+            return ""
     
     def extract_text_ocr(self, pdf_path: str) -> str:
         """
@@ -47,23 +113,18 @@ class PDFHandler:
         Returns:
             str: Extracted text
         """
-        text = ""
         try:
-            # Convert PDF to images
-            images = convert_from_path(pdf_path)
-            
-            # OCR each page
-            for i, image in enumerate(images):
-                page_text = pytesseract.image_to_string(image)
-                text += f"\n--- Page {i+1} ---\n{page_text}"
+            with fitz.open(pdf_path) as doc:
+                return self._extract_ocr_text(doc)
         except Exception as e:
             print(f"OCR extraction error: {e}")
-        return text.strip()
+            return ""
     
     def extract_text(self, pdf_path: str) -> str:
         """
         Extract text from PDF with fallback strategy.
         First tries PyMuPDF, falls back to OCR if insufficient text.
+        The PDF is parsed once and shared by both passes.
         
         Args:
             pdf_path: Path to the PDF file
@@ -71,13 +132,28 @@ class PDFHandler:
         Returns:
             str: Extracted text
         """
-        # Try PyMuPDF first
-        text = self.extract_text_pymupdf(pdf_path)
+        try:
+            doc = fitz.open(pdf_path)
+        except Exception as e:
+            print(f"PyMuPDF open error: {e}")
+            return ""
         
-        # If insufficient text, fallback to OCR
-        if len(text) < self.min_text_threshold:
-            print(f"PyMuPDF extracted only {len(text)} chars. Falling back to OCR...")
-            text = self.extract_text_ocr(pdf_path)
+        with doc:
+            # Try PyMuPDF first
+            try:
+                text = self._extract_native_text(doc)
+            except Exception as e:
+                print(f"PyMuPDF extraction error: {e}")
+                text = ""
+            
+            # If insufficient text, fallback to OCR
+            if len(text) < self.min_text_threshold:
+                print(f"PyMuPDF extracted only {len(text)} chars. Falling back to OCR...")
+                try:
+                    text = self._extract_ocr_text(doc)
+                except Exception as e:
+                    print(f"OCR extraction error: {e}")
+                    text = ""
         
         return text
 
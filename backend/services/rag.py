@@ -1,23 +1,73 @@
 from google import genai
 import weaviate
 from weaviate.auth import AuthApiKey
+from weaviate.config import AdditionalConfig, ConnectionConfig, Timeout
 from config import settings
-from typing import List, Tuple
+from services import reranker
+from services.cache import SingleFlight, TTLCache
+from services.storage import storage
+from typing import List, Optional
+import array
+import hashlib
+import threading
 
-# Initialize Weaviate client
+# Separator line between formatted context blocks
+CONTEXT_SEPARATOR = "=" * 80
+
+# Object properties read when formatting context blocks
+RETURN_PROPERTIES = ["content", "filename", "chunk_index"]
+
+# Gemini client shared by all embedding calls, so connections are reused
+_genai_client = genai.Client(api_key=settings.gemini_api_key)
+
+_client: Optional[weaviate.WeaviateClient] = None
+_collection = None
+_client_lock = threading.Lock()
+
+# Shared Weaviate client, connected once per process
 def get_client() -> weaviate.WeaviateClient:
-    return weaviate.connect_to_weaviate_cloud(
-        cluster_url=settings.weaviate_url,
-        auth_credentials=AuthApiKey(settings.weaviate_api_key),
-        headers={"X-OpenAI-Project": "legal-rag"}
-    )
+    global _client, _collection
+    if _client is None or not _client.is_connected():
+        # Chat turns run in worker threads; only one of them may connect
+        with _client_lock:
+            if _client is None or not _client.is_connected():
+                if _client is not None:
+                    # Dropped connection; release it before reconnecting
+                    _client.close()
+                client = weaviate.connect_to_weaviate_cloud(
+                    cluster_url=settings.weaviate_url,
+                    auth_credentials=AuthApiKey(settings.weaviate_api_key),
+                    headers={"X-OpenAI-Project": "legal-rag"},
+                    additional_config=AdditionalConfig(
+                        timeout=Timeout(init=5, query=30, insert=60),
+                        connection=ConnectionConfig(
+                            session_pool_connections=50,
+                            session_pool_maxsize=100
+                        )
+                    )
+                )
+                _collection = client.collections.get(settings.collection_name)
+                _client = client
+    return _client
+
+# Collection handle bound to the shared client, looked up once
+def get_collection():
+    get_client()
+    return _collection
+
+def close_client() -> None:
+    global _client, _collection
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+            _collection = None
 
 # Embed a query string using Gemini Embedding
-def embed_query(query: str) -> List[float]:
+def _embed_query_remote(query: str) -> List[float]:
     """Embed a query string using Gemini."""
-    client = genai.Client(api_key=settings.gemini_api_key)
     # Note: dimensions parameter is not supported in this version of google-genai
-    response = client.models.embed_content(
+    response = _genai_client.models.embed_content(
         model=settings.embedding_model,
         contents=query,
     )
@@ -46,51 +96,103 @@ def embed_query(query: str) -> List[float]:
         )
     return vector
 
+def _embedding_cache_key(query: str) -> str:
+    digest = hashlib.blake2b(query.encode(), digest_size=16).hexdigest()
+    return f"emb:f32:{settings.embedding_model}:{digest}"
+
+# Embed a query string, reusing cached vectors for repeated text
+def embed_query(query: str) -> List[float]:
+    """Embed a query string, caching the vector in Redis as packed float32."""
+    key = _embedding_cache_key(query)
+    cached = storage.get_cached(key)
+    if cached is not None:
+        vector = array.array("f")
+        vector.frombytes(cached)
+        return vector.tolist()
+    
+    # Return the float32-rounded vector on a miss too, so a query searches
+    # with the same vector whether or not the cache was warm
+    vector = array.array("f", _embed_query_remote(query))
+    storage.set_cached(key, vector.tobytes(), settings.embedding_cache_ttl)
+    return vector.tolist()
+
 # Retrieve documents similar to query
 def retrieve(
-    client: weaviate.WeaviateClient, query: str, top_k: int = 4, alpha: float = 0.5
-) -> List[Tuple[str, str, int, float]]:
-    """Hybrid search returning (content, filename, chunk_index, score)."""
-    collection = client.collections.get(settings.collection_name)
+    collection, query: str, top_k: int = 4, alpha: float = 0.5
+) -> str:
+    """Hybrid search returning formatted context blocks, one per (filename, chunk_index)."""
     query_vector = embed_query(query)
     result = collection.query.hybrid(
         query=query,
         vector=query_vector,
         alpha=alpha,
-        limit=top_k,
-        return_metadata=weaviate.classes.query.MetadataQuery(distance=True, score=True),
+        # Over-fetch when a reranker will pick the final top_k
+        limit=settings.rerank_candidates if reranker.is_enabled() else top_k,
+        # Only fetch what the context blocks use; skips vectors and unused properties
+        return_properties=RETURN_PROPERTIES,
+        return_metadata=weaviate.classes.query.MetadataQuery(score=True),
+        include_vector=False,
     )
-    hits: List[Tuple[str, str, int, float]] = []
+    # Results come back best-first, so the first time a chunk is seen
+    # carries its highest score; later duplicates are skipped
+    seen = set()
+    hits: List[reranker.Hit] = []
     for o in result.objects:
         props = o.properties
+        identifier = (props.get("filename", ""), props.get("chunk_index", -1))
+        if identifier in seen:
+            continue
+        seen.add(identifier)
         score = o.metadata.score if hasattr(o.metadata, "score") else None
-        hits.append(
-            (
-                props.get("content", ""),
-                props.get("filename", ""),
-                props.get("chunk_index", -1),
-                score if score is not None else 0.0,
-            )
-        )
+        hits.append((props.get("content", ""), *identifier, score if score is not None else 0.0))
 
-    context_blocks = []
-    for idx, (content, filename, chunk_idx, score) in enumerate(hits, 1):
-        context_blocks.append(
-            f"[Context {idx}] Source: {filename} (Chunk {chunk_idx}, Relevance Score: {score:.4f})\n{content}"
-        )
-    context_text = "\n\n" + "="*80 + "\n\n".join(context_blocks) + "\n\n" + "="*80
+    if reranker.is_enabled():
+        hits = reranker.rerank(query, hits, top_k)
+
+    context_blocks = [
+        f"[Context {idx}] Source: {filename} (Chunk {chunk_idx}, Relevance Score: {score:.4f})\n{content}"
+        for idx, (content, filename, chunk_idx, score) in enumerate(hits, 1)
+    ]
+    # Every block sits between separators so it can be split back out
+    separator = "\n\n" + CONTEXT_SEPARATOR + "\n\n"
+    context_text = separator + separator.join(context_blocks) + separator
     
     return context_text
 
+# Hot repeats are served in-process; Redis shares results across workers
+_context_cache = TTLCache(maxsize=512, ttl=settings.rag_cache_ttl)
+_context_inflight = SingleFlight()
+
+def _context_cache_key(query: str, top_k: int) -> str:
+    normalized = " ".join(query.lower().split())
+    digest = hashlib.blake2b(f"{top_k}|{normalized}".encode(), digest_size=16).hexdigest()
+    return f"rag:{digest}"
+
 def get_context(query: str, top_k: int = 4) -> str:
-    client = get_client()
-    try:
-        return retrieve(client, query, top_k)
-    finally:
-        client.close()
+    """Retrieve formatted context for a query, using the two-tier cache."""
+    key = _context_cache_key(query, top_k)
+    context = _context_cache.get(key)
+    if context is not None:
+        return context
+    
+    # Identical queries arriving together share one lookup
+    context = _context_inflight.do(key, _load_context, key, query, top_k)
+    _context_cache.set(key, context)
+    return context
+
+def _load_context(key: str, query: str, top_k: int) -> str:
+    cached = storage.get_cached(key)
+    if cached is not None:
+        return cached.decode()
+    context = retrieve(get_collection(), query, top_k)
+    storage.set_cached(key, context, settings.rag_cache_ttl)
+    return context
 
 
 if __name__ == "__main__":
     query = "if my yearly income is 600000 and expense is 500000. i can save only 100000. will i have to pay tax"
-    context = get_context(query)
-    print(context)
\ No newline at end of file
+    try:
+        context = get_context(query)
+        print(context)
+    finally:
+        close_client()
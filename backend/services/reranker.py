@@ -0,0 +1,106 @@
+import hashlib
+import re
+import threading
+from typing import List, Tuple
+
+from config import settings
+from services.storage import storage
+
+# (content, filename, chunk_index, score), as produced by rag.retrieve
+Hit = Tuple[str, str, int, float]
+
+# Quoted phrases and bare filenames are exact lookups; hybrid order is kept
+_LITERAL_QUERY_RE = re.compile(r'\s*(?:"[^"]+"|\'[^\']+\'|[\w\-.]+\.(?:pdf|txt|docx?))\s*', re.IGNORECASE)
+
+BATCH_SIZE = 32
+
+_model = None
+_tokenizer = None
+_model_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    """Whether a rerank model is configured."""
+    return bool(settings.rerank_model)
+
+
+def _load_model():
+    """Load the cross-encoder once per process; returns (tokenizer, model) or (None, None)."""
+    global _model, _tokenizer
+    if _model is None:
+        try:
+            from transformers import AutoModelForSequenceClassification, AutoTokenizer
+            _tokenizer = AutoTokenizer.from_pretrained(settings.rerank_model)
+            model = AutoModelForSequenceClassification.from_pretrained(settings.rerank_model)
+            model.eval()
+            _model = model
+        except Exception as e:
+            print(f"Error loading rerank model: {e}")
+            _model = False
+    return (_tokenizer, _model) if _model else (None, None)
+
+
+def _score_pairs(query: str, contents: List[str]) -> List[float]:
+    """Score (query, content) pairs with the cross-encoder."""
+    import torch
+
+    # Fast tokenizers aren't safe to pad/truncate from several threads at once
+    with _model_lock:
+        tokenizer, model = _load_model()
+        if model is None:
+            return []
+        scores = []
+        with torch.inference_mode():
+            for start in range(0, len(contents), BATCH_SIZE):
+                batch = contents[start:start + BATCH_SIZE]
+                inputs = tokenizer(
+                    [query] * len(batch),
+                    batch,
+                    padding=True,
+                    truncation=True,
+                    max_length=512,
+                    return_tensors="pt"
+                )
+                logits = model(**inputs).logits.view(-1).float()
+                scores.extend(torch.sigmoid(logits).tolist())
+        return scores
+
+
+def _score_cache_key(query_digest: str, content: str) -> str:
+    content_digest = hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+    return f"rerank:{settings.rerank_model}:{query_digest}:{content_digest}"
+
+
+def rerank(query: str, hits: List[Hit], top_k: int) -> List[Hit]:
+    """
+    Reorder hits by cross-encoder relevance and keep the best top_k.
+
+    Scores are cached per (query, chunk) in Redis, so only unseen pairs
+    reach the model. Literal lookups and failures keep the hybrid order.
+
+    Args:
+        query: User query
+        hits: Candidate hits from hybrid search, best first
+        top_k: Number of hits to keep
+
+    Returns:
+        List[Hit]: Top hits carrying their rerank scores
+    """
+    if len(hits) <= 1 or _LITERAL_QUERY_RE.fullmatch(query):
+        return hits[:top_k]
+
+    query_digest = hashlib.blake2b(query.encode(), digest_size=16).hexdigest()
+    keys = [_score_cache_key(query_digest, content) for content, _, _, _ in hits]
+    scores = [float(value) if value is not None else None for value in storage.get_cached_many(keys)]
+
+    missing = [i for i, score in enumerate(scores) if score is None]
+    if missing:
+        computed = _score_pairs(query, [hits[i][0] for i in missing])
+        if not computed:
+            return hits[:top_k]
+        for i, score in zip(missing, computed):
+            scores[i] = score
+        storage.set_cached_many({keys[i]: repr(scores[i]) for i in missing}, settings.rerank_cache_ttl)
+
+    ranked = sorted(zip(hits, scores), key=lambda pair: pair[1], reverse=True)
+    return [(content, filename, chunk_idx, score) for (content, filename, chunk_idx, _), score in ranked[:top_k]]
@@ -1,81 +1,181 @@
 import redis
-import json
-from typing import List, Dict
+import orjson
+from typing import List, Dict, Optional, Tuple, Union
 from config import settings
 
 
+# Push the system prompt (ARGV[1]) only if the history is still empty, then
+# the rest; concurrent first turns on a new session leave a single prompt
+_START_HISTORY_LUA = """
+if redis.call('LLEN', KEYS[1]) == 0 then
+    return redis.call('RPUSH', KEYS[1], unpack(ARGV))
+end
+if #ARGV > 1 then
+    return redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+
 class RedisStorage:
     def __init__(self):
-        self.client = redis.Redis(
+        # One bounded pool per process; callers wait for a free connection
+        # instead of opening new ones under load
+        self.pool = redis.BlockingConnectionPool(
             host=settings.redis_host,
             port=settings.redis_port,
             db=settings.redis_db,
             password=settings.redis_password,
-            decode_responses=True
+            # orjson reads and writes bytes; only keys and cached text are decoded
+            decode_responses=False,
+            max_connections=settings.redis_max_connections,
+            timeout=5
         )
+        self.client = redis.Redis(connection_pool=self.pool)
+        self._start_history = self.client.register_script(_START_HISTORY_LUA)
     
     def get_history(self, session_id: str) -> List[Dict[str, str]]:
         """Retrieve chat history for a session."""
-        history_json = self.client.get(f"chat:{session_id}")
-        if history_json:
-            return json.loads(history_json)
-        return []
+        key = f"chat:{session_id}"
+        try:
+            items = self.client.lrange(key, 0, -1)
+        except redis.ResponseError:
+            # Legacy sessions stored the whole history as one JSON string;
+            # convert them to a list the first time they are read
+            history = self._convert_legacy_history(key)
+            if history is not None:
+                return history
+            # Another reader converted it first
+            items = self.client.lrange(key, 0, -1)
+        return [orjson.loads(item) for item in items]
+    
+    def _convert_legacy_history(self, key: str) -> Optional[List[Dict[str, str]]]:
+        """
+        Atomically rewrite a legacy JSON-string history as a list.
+        Returns the history, or None if the key is no longer a string.
+        """
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    if pipe.type(key) != b"string":
+                        return None
+                    history = orjson.loads(pipe.get(key))
+                    pipe.multi()
+                    pipe.delete(key)
+                    if history:
+                        pipe.rpush(key, *[orjson.dumps(message) for message in history])
+                    pipe.execute()
+                    return history
+                except redis.WatchError:
+                    # Key changed while converting; check it again
+                    continue
     
     def save_history(self, session_id: str, history: List[Dict[str, str]]) -> None:
-        """Save chat history for a session."""
-        self.client.set(f"chat:{session_id}", json.dumps(history))
+        """Replace the chat history for a session."""
+        key = f"chat:{session_id}"
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        if history:
+            pipe.rpush(key, *[orjson.dumps(message) for message in history])
+        pipe.execute()
     
     def append_message(self, session_id: str, role: str, content: str) -> None:
         """Append a single message to the history."""
-        history = self.get_history(session_id)
-        history.append({"role": role, "content": content})
-        self.save_history(session_id, history)
+        self.append_messages(session_id, [{"role": role, "content": content}])
+    
+    def append_messages(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        """Append messages to the history in a single round trip."""
+        if messages:
+            self.client.rpush(f"chat:{session_id}", *[orjson.dumps(message) for message in messages])
+    
+    def start_history(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        """
+        Append the first turn of a new session, starting with its system prompt.
+        The system prompt is written only if the history is still empty, so a
+        concurrent first turn that got there first is appended to instead.
+        """
+        self._start_history(
+            keys=[f"chat:{session_id}"],
+            args=[orjson.dumps(message) for message in messages]
+        )
     
     def clear_history(self, session_id: str) -> None:
         """Clear chat history for a session."""
         self.client.delete(f"chat:{session_id}")
-        # Also delete metadata
+        # Also delete metadata and knowledge base
         self.client.delete(f"chat_meta:{session_id}")
+        self.client.delete(f"chat_kb:{session_id}")
+    
+    def get_knowledge_base(self, session_id: str) -> Dict[Tuple[str, int], str]:
+        """Get the session's RAG knowledge base, keyed by (filename, chunk_idx)."""
+        kb_json = self.client.get(f"chat_kb:{session_id}")
+        if kb_json:
+            return {(filename, chunk_idx): block for filename, chunk_idx, block in orjson.loads(kb_json)}
+        return {}
+    
+    def save_knowledge_base(self, session_id: str, knowledge_base: Dict[Tuple[str, int], str]) -> None:
+        """Save the session's RAG knowledge base, preserving insertion order."""
+        entries = [[filename, chunk_idx, block] for (filename, chunk_idx), block in knowledge_base.items()]
+        self.client.set(f"chat_kb:{session_id}", orjson.dumps(entries))
     
     def get_all_sessions(self) -> List[Dict[str, str]]:
         """Get all chat sessions with metadata."""
-        sessions = []
-        # Get all chat session keys
-        keys = self.client.keys("chat:*")
+        import time
+        # SCAN instead of KEYS so a large keyspace doesn't block Redis;
+        # SCAN may return a key more than once, so dedupe in order
+        session_ids = list(dict.fromkeys(
+            key.decode().replace("chat:", "", 1)
+            for key in self.client.scan_iter(match="chat:*", count=500)
+        ))
+        # Skip metadata keys
+        session_ids = [session_id for session_id in session_ids if not session_id.startswith("meta:")]
+        if not session_ids:
+            return []
         
-        for key in keys:
-            session_id = key.replace("chat:", "")
-            # Skip metadata keys
-            if session_id.startswith("meta:"):
+        # The first user message follows the system prompt, so only the
+        # head of each history is needed for the preview
+        pipe = self.client.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.lrange(f"chat:{session_id}", 0, 1)
+        heads = pipe.execute(raise_on_error=False)
+        
+        meta_values = self.client.mget([f"chat_meta:{session_id}" for session_id in session_ids])
+        
+        sessions = []
+        missing_meta = {}
+        for session_id, head, meta_json in zip(session_ids, heads, meta_values):
+            if isinstance(head, redis.ResponseError):
+                # Legacy string history; get_history converts it
+                head = self.get_history(session_id)[:2]
+            else:
+                head = [orjson.loads(item) for item in head]
+            if not head:
                 continue
-                
-            history = self.get_history(session_id)
-            if history:
-                # Get first user message as preview
-                first_message = next((msg for msg in history if msg.get("role") == "user"), None)
-                preview = first_message.get("content", "New Chat")[:50] if first_message else "New Chat"
-                
-                # Get or create metadata
-                meta_key = f"chat_meta:{session_id}"
-                meta_json = self.client.get(meta_key)
-                
-                if meta_json:
-                    metadata = json.loads(meta_json)
-                else:
-                    # Create metadata if it doesn't exist
-                    import time
-                    metadata = {
-                        "created_at": int(time.time()),
-                        "updated_at": int(time.time())
-                    }
-                    self.client.set(meta_key, json.dumps(metadata))
-                
-                sessions.append({
-                    "session_id": session_id,
-                    "preview": preview,
-                    "created_at": metadata.get("created_at"),
-                    "updated_at": metadata.get("updated_at")
-                })
+            
+            # Get first user message as preview
+            first_message = next((msg for msg in head if msg.get("role") == "user"), None)
+            preview = first_message.get("content", "New Chat")[:50] if first_message else "New Chat"
+            
+            if meta_json:
+                metadata = orjson.loads(meta_json)
+            else:
+                # Create metadata if it doesn't exist
+                metadata = {
+                    "created_at": int(time.time()),
+                    "updated_at": int(time.time())
+                }
+                missing_meta[f"chat_meta:{session_id}"] = orjson.dumps(metadata)
+            
+            sessions.append({
+                "session_id": session_id,
+                "preview": preview,
+                "created_at": metadata.get("created_at"),
+                "updated_at": metadata.get("updated_at")
+            })
+        
+        if missing_meta:
+            self.client.mset(missing_meta)
         
         # Sort by updated_at descending
         sessions.sort(key=lambda x: x.get("updated_at", 0), reverse=True)
@@ -88,7 +188,7 @@ class RedisStorage:
         meta_json = self.client.get(meta_key)
         
         if meta_json:
-            metadata = json.loads(meta_json)
+            metadata = orjson.loads(meta_json)
             metadata["updated_at"] = int(time.time())
         else:
             metadata = {
@@ -96,33 +196,65 @@ class RedisStorage:
                 "updated_at": int(time.time())
             }
         
-        self.client.set(meta_key, json.dumps(metadata))
+        self.client.set(meta_key, orjson.dumps(metadata))
     
     def add_pending_document(self, session_id: str, filename: str, file_path: str, extracted_text: str) -> None:
         """Add a document to the pending list for this session."""
         pending_key = f"pending_docs:{session_id}"
-        pending_docs = self.get_pending_documents(session_id)
-        
-        pending_docs.append({
+        doc = orjson.dumps({
             "filename": filename,
             "file_path": file_path,
             "extracted_text": extracted_text
         })
         
-        self.client.set(pending_key, json.dumps(pending_docs))
+        try:
+            self.client.rpush(pending_key, doc)
+        except redis.ResponseError:
+            # Legacy JSON blob; rewrite it as a list including the new document
+            pending_docs = [orjson.dumps(d) for d in orjson.loads(self.client.get(pending_key))]
+            pipe = self.client.pipeline()
+            pipe.delete(pending_key)
+            pipe.rpush(pending_key, *pending_docs, doc)
+            pipe.execute()
     
     def get_pending_documents(self, session_id: str) -> List[Dict[str, str]]:
         """Get all pending documents for this session."""
         pending_key = f"pending_docs:{session_id}"
-        pending_json = self.client.get(pending_key)
-        if pending_json:
-            return json.loads(pending_json)
-        return []
+        try:
+            return [orjson.loads(item) for item in self.client.lrange(pending_key, 0, -1)]
+        except redis.ResponseError:
+            # Legacy JSON blob written before pending docs became a list
+            return orjson.loads(self.client.get(pending_key))
     
     def clear_pending_documents(self, session_id: str) -> None:
         """Clear all pending documents for this session."""
         pending_key = f"pending_docs:{session_id}"
         self.client.delete(pending_key)
+    
+    def get_cached(self, key: str) -> Optional[bytes]:
+        """Get a cached value by key, or None if missing/expired."""
+        return self.client.get(key)
+    
+    def set_cached(self, key: str, value: Union[str, bytes], ttl: int) -> None:
+        """Cache a value under key for ttl seconds; a ttl of 0 or less disables caching."""
+        if ttl <= 0:
+            return
+        self.client.setex(key, ttl, value)
+    
+    def get_cached_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Get several cached values in one round trip; None for each miss."""
+        if not keys:
+            return []
+        return self.client.mget(keys)
+    
+    def set_cached_many(self, values: Dict[str, Union[str, bytes]], ttl: int) -> None:
+        """Cache several values for ttl seconds in one round trip; a ttl of 0 or less disables caching."""
+        if not values or ttl <= 0:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.setex(key, ttl, value)
+        pipe.execute()
 
 
 # Singleton instance
@@ -1,12 +1,46 @@
+import hashlib
+import threading
 from typing import List, Dict
 
+from config import settings
+from services.cache import TTLCache
 
-def count_tokens(text: str) -> int:
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+# Token counts keyed by a digest of the text, so memory is bounded by
+# entry count rather than by prompt/document size; evicted least recently used
+_token_counts = TTLCache(maxsize=8192)
+
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def get_tokenizer():
     """
-    Count tokens using Hugging Face AutoTokenizer.
+    Get the process-wide tokenizer for the configured model.
     
-    This function is left as a placeholder for you to implement
-    with the exact model tokenizer.
+    Loaded lazily on first use. Returns None if it can't be loaded, in
+    which case token counts fall back to a word-based estimate.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                try:
+                    from transformers import AutoTokenizer
+                    _tokenizer = AutoTokenizer.from_pretrained(settings.model_hf_path)
+                except Exception as e:
+                    print(f"Error loading tokenizer: {e}")
+                    _tokenizer = False
+    return _tokenizer or None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens using the model's Hugging Face tokenizer.
     
     Args:
         text: The text to count tokens for
@@ -14,15 +48,53 @@ def count_tokens(text: str) -> int:
     Returns:
         int: Number of tokens in the text
     """
-    # TODO: Implement using transformers.AutoTokenizer
-    # Example implementation:
-    # from transformers import AutoTokenizer
-    # from config import settings
-    # tokenizer = AutoTokenizer.from_pretrained(settings.model_hf_path)
-    # return len(tokenizer.encode(text))
+    return count_tokens_batch([text])[0]
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    """
+    Count tokens for several texts with one tokenizer call.
     
-    # Temporary approximation (remove when implementing)
-    return len(text.split()) * 2
+    Counts are memoized, since the system prompt and earlier history are
+    re-counted on every turn; only unseen texts are encoded.
+    
+    Args:
+        texts: The texts to count tokens for
+        
+    Returns:
+        List[int]: Number of tokens in each text
+    """
+    keys = [_text_key(text) for text in texts]
+    counts = [_token_counts.get(key) for key in keys]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        tokenizer = get_tokenizer()
+        if tokenizer is None:
+            computed = [len(text.split()) * 2 for text in missing_texts]
+        else:
+            computed = [len(ids) for ids in tokenizer(missing_texts, add_special_tokens=False)["input_ids"]]
+        for i, count in zip(missing, computed):
+            counts[i] = count
+            _token_counts.set(keys[i], count)
+    return counts
+
+
+def message_token_counts(messages: List[Dict[str, str]]) -> List[int]:
+    """
+    Count tokens for each message in a list.
+    
+    Args:
+        messages: List of message dictionaries with 'role' and 'content'
+        
+    Returns:
+        List[int]: Number of tokens in each message
+    """
+    # Roles and contents go through one batched call; +2 covers the
+    # separator between them
+    counts = count_tokens_batch([m["role"] for m in messages] + [m["content"] for m in messages])
+    n = len(messages)
+    return [role + content + 2 for role, content in zip(counts[:n], counts[n:])]
 
 
 def count_messages_tokens(messages: List[Dict[str, str]]) -> int:
@@ -35,8 +107,4 @@ def count_messages_tokens(messages: List[Dict[str, str]]) -> int:
     Returns:
         int: Total number of tokens
     """
-    total = 0
-    for message in messages:
-        # Count tokens for role and content
-        total += count_tokens(f"{message['role']}: {message['content']}")
-    return total
+    return sum(message_token_counts(messages))
@@ -1,17 +1,14 @@
 """
 Test script to demonstrate RAG context deduplication.
 
-This script shows how the _update_knowledge_base method deduplicates
+This script shows how the _merge_knowledge_base method deduplicates
 contexts based on filename and chunk_index.
 """
 
 from services.chat import chat_service
 
-# Simulate initial system prompt
-system_prompt = """You are strictly bound to reply based on the relevant context. If relevant context is empty, say that you're sorry and you cannot answer this question.
-
-<knowledge_base>
-</knowledge_base>"""
+# Simulate an empty session knowledge base
+knowledge_base = {}
 
 # First RAG retrieval (simulated)
 first_context = """
@@ -49,28 +46,54 @@ print("=" * 80)
 
 # First update
 print("\n1. Adding first context (2 new contexts):")
-updated_prompt_1 = chat_service._update_knowledge_base(system_prompt, first_context)
-print(f"   - Added contexts from: tax_guide.pdf (Chunk 5), business_expenses.pdf (Chunk 12)")
+added = chat_service._merge_knowledge_base(knowledge_base, first_context)
+print(f"   - Added {added} contexts from: tax_guide.pdf (Chunk 5), business_expenses.pdf (Chunk 12)")
 
 # Second update (should only add the new context)
 print("\n2. Adding second context (1 duplicate, 1 new):")
-updated_prompt_2 = chat_service._update_knowledge_base(updated_prompt_1, second_context)
+added = chat_service._merge_knowledge_base(knowledge_base, second_context)
 print(f"   - Skipped duplicate: tax_guide.pdf (Chunk 5)")
-print(f"   - Added new context: municipal_taxes.pdf (Chunk 8)")
+print(f"   - Added {added} new context: municipal_taxes.pdf (Chunk 8)")
 
-# Extract and count contexts
-kb_start = updated_prompt_2.find("<knowledge_base>")
-kb_end = updated_prompt_2.find("</knowledge_base>")
-kb_content = updated_prompt_2[kb_start:kb_end + len("</knowledge_base>")]
+# Render and count contexts
+system_prompt = chat_service._render_system_prompt(knowledge_base)["content"]
+kb_start = system_prompt.find("<knowledge_base>")
+kb_end = system_prompt.find("</knowledge_base>")
+kb_content = system_prompt[kb_start:kb_end + len("</knowledge_base>")]
 
 context_count = kb_content.count("[Context")
 print(f"\n3. Final knowledge base contains {context_count} unique contexts")
 
 # Show identifiers
-identifiers = chat_service._extract_context_identifiers(kb_content)
 print(f"\n4. Unique context identifiers:")
-for filename, chunk_idx in sorted(identifiers):
+for filename, chunk_idx in sorted(knowledge_base):
+    print(f"   - {filename} (Chunk {chunk_idx})")
+
+# Older sessions stored the knowledge base inline in the system prompt,
+# appended the way the previous _update_knowledge_base did
+def legacy_update(system_content, new_context):
+    kb_start = system_content.find("<knowledge_base>")
+    kb_end = system_content.find("</knowledge_base>")
+    kb_content = system_content[kb_start + len("<knowledge_base>"):kb_end].strip()
+    blocks = [part.strip() for part in new_context.split("=" * 80) if part.strip()]
+    new_contexts_text = "\n\n" + ("=" * 80 + "\n\n").join(blocks)
+    updated_kb = kb_content + new_contexts_text if kb_content else new_contexts_text.strip()
+    before_kb = system_content[:kb_start]
+    after_kb = system_content[kb_end + len("</knowledge_base>"):]
+    return f"{before_kb}<knowledge_base>\n{updated_kb}\n</knowledge_base>{after_kb}"
+
+legacy_prompt = legacy_update(chat_service._initialize_system_prompt()["content"], first_context)
+
+print("\n5. Migrating a legacy inline knowledge base:")
+migrated = chat_service._parse_legacy_knowledge_base(legacy_prompt)
+for (filename, chunk_idx), block in migrated.items():
     print(f"   - {filename} (Chunk {chunk_idx})")
+    assert "knowledge_base>" not in block, f"tag leaked into block: {block!r}"
+assert sorted(migrated) == [("business_expenses.pdf", 12), ("tax_guide.pdf", 5)]
+
+rendered = chat_service._render_system_prompt(migrated)["content"]
+assert rendered.count("</knowledge_base>") == 1
+print("   - Rendered prompt has a single closing </knowledge_base> tag")
 
 print("\n" + "=" * 80)
 print("TEST COMPLETE")